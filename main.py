@@ -1,21 +1,43 @@
+import asyncio
+import logging
 import os
-from io import StringIO
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from contextlib import asynccontextmanager
+from io import BytesIO, TextIOWrapper
+from itertools import islice
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, GetCoreSchemaHandler, HttpUrl, TypeAdapter, ValidationError
+from pydantic_core import core_schema
+from typing import List, Optional, get_args
 from bson import ObjectId
+from bson.errors import InvalidDocument
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+from motor.motor_asyncio import AsyncIOMotorDatabase
 import csv
-import requests
+import gzip
+import re
+import httpx
+import orjson
 
-from database import db, create_document, get_documents
+from database import db, create_document, create_document_dict, get_documents
 from schemas import Product as ProductSchema, Order as OrderSchema, Contact as ContactSchema, Gallery as GallerySchema, Post as PostSchema
 
+logger = logging.getLogger(__name__)
+
 class ObjectIdStr(str):
     @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
+    def __get_pydantic_core_schema__(cls, source, handler: GetCoreSchemaHandler) -> core_schema.CoreSchema:
+        # Native v2 schema: the str check runs in pydantic-core, only the ObjectId check is Python
+        from_str = core_schema.no_info_after_validator_function(cls.validate, core_schema.str_schema())
+        return core_schema.json_or_python_schema(
+            json_schema=from_str,
+            python_schema=core_schema.union_schema([
+                core_schema.no_info_after_validator_function(cls.validate, core_schema.is_instance_schema(ObjectId)),
+                from_str,
+            ]),
+        )
 
     @classmethod
     def validate(cls, v):
@@ -35,20 +57,46 @@ class ProductOut(BaseModel):
     care: Optional[str] = None
     image: Optional[str] = None
 
-    @classmethod
-    def from_mongo(cls, doc: dict):
-        return cls(
-            id=str(doc.get("_id")),
-            name=doc.get("name"),
-            category=doc.get("category"),
-            price=doc.get("price"),
-            availability=doc.get("availability"),
-            sku=doc.get("sku"),
-            care=doc.get("care"),
-            image=str(doc.get("image")) if doc.get("image") else None,
-        )
+def _encode_object_id(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class MongoJSONResponse(ORJSONResponse):
+    """ORJSONResponse that also encodes ObjectId, stringified inside orjson"""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_encode_object_id)
 
-app = FastAPI(title="Mimoza API")
+def product_to_dict(doc: dict) -> dict:
+    """Plain ProductOut-shaped dict for list responses; id stays an ObjectId for MongoJSONResponse"""
+    return {
+        "id": doc["_id"],
+        "name": doc.get("name"),
+        "category": doc.get("category"),
+        "price": doc.get("price"),
+        "availability": doc.get("availability"),
+        "sku": doc.get("sku"),
+        "care": doc.get("care"),
+        "image": str(doc["image"]) if doc.get("image") else None,
+    }
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # In the background so an unreachable Mongo doesn't hold startup for the server-selection timeout
+    index_task = asyncio.create_task(ensure_indexes())
+    # One app-wide webhook client: keep-alive and HTTP/2 multiplexing amortize the TLS handshake
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
+    try:
+        yield
+    finally:
+        index_task.cancel()
+        await app.state.http.aclose()
+
+app = FastAPI(title="Mimoza API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -59,11 +107,11 @@ app.add_middleware(
 )
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Rasadnik i Cvjećarna Mimoza API"}
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -75,7 +123,7 @@ def test_database():
     try:
         if db is not None:
             response["database"] = "✅ Available"
-            collections = db.list_collection_names()
+            collections = await db.list_collection_names()
             response["collections"] = collections
             response["connection_status"] = "Connected"
             response["database"] = "✅ Connected & Working"
@@ -92,173 +140,332 @@ COLL_CONTACT = "contact"
 COLL_GALLERY = "gallery"
 COLL_POSTS = "post"
 
-# Products
-@app.get("/api/products", response_model=List[ProductOut])
-def list_products(category: Optional[str] = None, availability: Optional[str] = None, q: Optional[str] = None):
+# Projections for list views; post bodies are only served by the detail endpoint
+PRODUCT_FIELDS = {"name": 1, "category": 1, "price": 1, "availability": 1, "sku": 1, "care": 1, "image": 1}
+GALLERY_FIELDS = {"title": 1, "category": 1, "image": 1, "photographer": 1, "alt": 1}
+POST_LIST_FIELDS = {"title": 1, "slug": 1, "excerpt": 1, "cover_image": 1, "published": 1}
+
+_EMPTY_QUERY: dict = {}
+
+PRODUCT_LIST_INDEX = [("category", 1), ("availability", 1), ("name", 1)]
+
+# Short queries use an anchored prefix match on name, longer ones the text index
+PREFIX_SEARCH_MAX_LEN = 3
+
+# Backs the list_products filter + name sort, long name searches and the published posts feed
+INDEXES = [
+    (COLL_PRODUCTS, PRODUCT_LIST_INDEX, {}),
+    # Names are Croatian: tokenize only, no English stemming or stop words
+    (COLL_PRODUCTS, [("name", "text")], {"default_language": "none"}),
+    (COLL_POSTS, [("published", 1), ("_id", -1)], {}),
+]
+
+async def ensure_indexes():
     if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    query = {}
-    if category:
-        query["category"] = category
-    if availability:
-        query["availability"] = availability
-    if q:
-        query["name"] = {"$regex": q, "$options": "i"}
-    docs = db[COLL_PRODUCTS].find(query).sort("name", 1)
-    return [ProductOut.from_mongo(d) for d in docs]
+        return
+    # Each on its own so one failure (e.g. a conflicting text index) doesn't skip the rest
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception:
+            logger.exception("Failed to create index %s on %s", keys, collection)
 
-@app.post("/api/products", response_model=str)
-def create_product(product: ProductSchema):
-    return create_document(COLL_PRODUCTS, product)
+def _name_prefix(q: str) -> dict:
+    # Escaped and anchored so user input is matched literally as a name prefix, never as a
+    # regex pattern. With "i" Mongo still scans the index keys, so this isn't a range scan.
+    return {"$regex": f"^{re.escape(q)}", "$options": "i"}
+
+async def _find_products(db: AsyncIOMotorDatabase, query: dict) -> list:
+    # No hint: the index may not exist yet (or at all), and the planner picks it up on its own
+    cursor = db[COLL_PRODUCTS].find(query, PRODUCT_FIELDS).sort("name", 1).batch_size(200)
+    return await cursor.to_list(length=None)
 
-@app.put("/api/products/{product_id}", response_model=ProductOut)
-def update_product(product_id: str, product: ProductSchema):
+def require_db() -> AsyncIOMotorDatabase:
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
+    return db
+
+# Products
+@app.get("/api/products", response_class=MongoJSONResponse, responses={200: {"model": List[ProductOut]}})
+async def list_products(category: Optional[str] = None, availability: Optional[str] = None, q: Optional[str] = None, db: AsyncIOMotorDatabase = Depends(require_db)):
+    if category or availability or q:
+        query = {}
+        if category:
+            query["category"] = category
+        if availability:
+            query["availability"] = availability
+        if q:
+            if len(q) <= PREFIX_SEARCH_MAX_LEN:
+                query["name"] = _name_prefix(q)
+            else:
+                query["$text"] = {"$search": q}
+    else:
+        # Unfiltered listing shares one filter; the driver never mutates it
+        query = _EMPTY_QUERY
+    try:
+        docs = await _find_products(db, query)
+    except OperationFailure:
+        if "$text" not in query:
+            raise
+        # No usable text index (e.g. it failed to build); fall back to the prefix match
+        logger.warning("Text search failed, falling back to name prefix match", exc_info=True)
+        del query["$text"]
+        query["name"] = _name_prefix(q)
+        docs = await _find_products(db, query)
+    # Returning the response directly skips jsonable_encoder as well
+    return MongoJSONResponse([product_to_dict(d) for d in docs])
+
+@app.post("/api/products", response_model=str)
+async def create_product(product: ProductSchema):
+    return await create_document(COLL_PRODUCTS, product)
+
+@app.put("/api/products/{product_id}", response_class=MongoJSONResponse, responses={200: {"model": ProductOut}})
+async def update_product(product_id: str, product: ProductSchema, db: AsyncIOMotorDatabase = Depends(require_db)):
     if not ObjectId.is_valid(product_id):
         raise HTTPException(status_code=400, detail="Invalid id")
-    result = db[COLL_PRODUCTS].find_one_and_update(
+    result = await db[COLL_PRODUCTS].find_one_and_update(
         {"_id": ObjectId(product_id)},
         {"$set": product.model_dump()},
         return_document=True,
     )
     if not result:
         raise HTTPException(status_code=404, detail="Not found")
-    return ProductOut.from_mongo(result)
+    # ProductOut only documents the shape; the stored document needs no re-validation
+    return MongoJSONResponse(product_to_dict(result))
 
 @app.delete("/api/products/{product_id}")
-def delete_product(product_id: str):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
+async def delete_product(product_id: str, db: AsyncIOMotorDatabase = Depends(require_db)):
     if not ObjectId.is_valid(product_id):
         raise HTTPException(status_code=400, detail="Invalid id")
-    res = db[COLL_PRODUCTS].delete_one({"_id": ObjectId(product_id)})
+    res = await db[COLL_PRODUCTS].delete_one({"_id": ObjectId(product_id)})
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Not found")
     return {"ok": True}
 
 # CSV import/export
+IMPORT_BATCH_SIZE = 500
+
+async def _insert_batch(db: AsyncIOMotorDatabase, buffer: list) -> int:
+    # Unordered so one bad document doesn't abort the rest of the batch
+    try:
+        result = await db[COLL_PRODUCTS].insert_many(buffer, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        return e.details.get("nInserted", 0)
+
+_CAT_ALLOWED = frozenset(get_args(ProductSchema.model_fields["category"].annotation))
+_AVAIL_ALLOWED = frozenset(get_args(ProductSchema.model_fields["availability"].annotation))
+_IMAGE_URL = TypeAdapter(HttpUrl)
+
+def _row_to_doc(row: dict) -> Optional[dict]:
+    """Same checks as ProductSchema, done by hand; only the image URL goes through pydantic"""
+    name = row.get("name") or row.get("naziv")
+    category = row.get("category") or row.get("kategorija")
+    availability = row.get("availability") or row.get("dostupnost") or "na stanju"
+    if name is None or category not in _CAT_ALLOWED or availability not in _AVAIL_ALLOWED:
+        return None
+    try:
+        price = float(row.get("price") or row.get("cijena") or 0)
+    except ValueError:
+        return None
+    if not price >= 0:
+        return None
+    image = row.get("image") or row.get("slika")
+    if image:
+        try:
+            # Stored as a plain string so the document stays BSON-encodable
+            image = str(_IMAGE_URL.validate_python(image))
+        except ValidationError:
+            return None
+    return {
+        "name": name,
+        "category": category,
+        "price": price,
+        "availability": availability,
+        "sku": row.get("sku"),
+        "care": row.get("care") or row.get("njega"),
+        "image": image,
+    }
+
+def _read_batch(reader: csv.DictReader) -> Optional[list]:
+    """Parse the next IMPORT_BATCH_SIZE rows into documents, None once the file is exhausted"""
+    rows = list(islice(reader, IMPORT_BATCH_SIZE))
+    if not rows:
+        return None
+    docs = []
+    for row in rows:
+        doc = _row_to_doc(row)
+        if doc is not None:
+            docs.append(doc)
+    return docs
+
 @app.post("/api/products/import-csv")
-def import_products_csv(file: UploadFile = File(...)):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    content = file.file.read().decode("utf-8")
-    reader = csv.DictReader(StringIO(content))
+async def import_products_csv(file: UploadFile = File(...), db: AsyncIOMotorDatabase = Depends(require_db)):
+    # Stream the spooled upload row by row instead of decoding it into memory at once
+    text = TextIOWrapper(file.file, encoding="utf-8", newline="")
+    reader = csv.DictReader(text)
     inserted = 0
-    for row in reader:
-        try:
-            doc = ProductSchema(
-                name=row.get("name") or row.get("naziv"),
-                category=(row.get("category") or row.get("kategorija")),
-                price=float(row.get("price") or row.get("cijena") or 0),
-                availability=(row.get("availability") or row.get("dostupnost") or "na stanju"),
-                sku=row.get("sku"),
-                care=row.get("care") or row.get("njega"),
-                image=row.get("image") or row.get("slika"),
-            )
-            db[COLL_PRODUCTS].insert_one(doc.model_dump())
-            inserted += 1
-        except Exception:
-            continue
+    try:
+        # Parsing stays off the event loop; only the inserts are awaited here
+        while (docs := await run_in_threadpool(_read_batch, reader)) is not None:
+            if docs:
+                inserted += await _insert_batch(db, docs)
+    # Earlier batches are already committed, so report how far the import got
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail={
+            "error": f"Invalid CSV near line {reader.line_num}: {str(e)[:100]}",
+            "inserted": inserted,
+        })
+    except (PyMongoError, InvalidDocument) as e:
+        raise HTTPException(status_code=500, detail={
+            "error": f"Database error: {str(e)[:100]}",
+            "inserted": inserted,
+        })
+    finally:
+        # Leave the underlying file to UploadFile, which closes it itself
+        text.detach()
     return {"inserted": inserted}
 
+class _Echo:
+    """Pseudo-buffer so csv.writer hands back each formatted row instead of storing it"""
+    def write(self, value):
+        return value
+
+EXPORT_COLUMNS = ["name", "category", "price", "availability", "sku", "care", "image"]
+# Line breaks in free-text fields are flattened so each product stays on one CSV line
+_CSV_TRANS = str.maketrans({"\n": " ", "\r": " "})
+
+EXPORT_GZIP_FLUSH_ROWS = 1000
+
+async def _gzip_stream(chunks, flush_rows: int = EXPORT_GZIP_FLUSH_ROWS):
+    """Compress text chunks on the fly, sync-flushing and yielding every flush_rows chunks"""
+    buffer = BytesIO()
+    # Level 1 keeps CPU negligible while still getting most of the ratio on repetitive columns
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=1) as gz:
+        rows = 0
+        async for chunk in chunks:
+            gz.write(chunk.encode("utf-8"))
+            rows += 1
+            if rows % flush_rows == 0:
+                # Z_SYNC_FLUSH costs a little ratio but ships each batch without waiting on zlib
+                gz.flush()
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    yield buffer.getvalue()
+
 @app.get("/api/products/export-csv")
-def export_products_csv():
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    docs = list(db[COLL_PRODUCTS].find())
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["name", "category", "price", "availability", "sku", "care", "image"])
-    for d in docs:
-        writer.writerow([
-            d.get("name", ""),
-            d.get("category", ""),
-            d.get("price", ""),
-            d.get("availability", ""),
-            d.get("sku", ""),
-            (d.get("care", "") or "").replace("\n", " "),
-            d.get("image", ""),
-        ])
-    output.seek(0)
-    return StreamingResponse(iter([output.getvalue()]), media_type="text/csv", headers={
-        "Content-Disposition": "attachment; filename=products.csv"
-    })
+async def export_products_csv(request: Request, db: AsyncIOMotorDatabase = Depends(require_db)):
+    writer = csv.writer(_Echo())
 
-# Orders
-@app.post("/api/orders")
-def create_order(order: OrderSchema):
-    oid = create_document(COLL_ORDERS, order)
-    webhook_url = os.getenv("WEBHOOK_URL")
+    # Async generator so StreamingResponse doesn't hop to the threadpool per chunk
+    async def gen():
+        yield writer.writerow(EXPORT_COLUMNS)
+        async for d in db[COLL_PRODUCTS].find({}, PRODUCT_FIELDS).batch_size(1000):
+            yield writer.writerow([
+                (d.get("name") or "").translate(_CSV_TRANS),
+                d.get("category", ""),
+                d.get("price", ""),
+                d.get("availability", ""),
+                (d.get("sku") or "").translate(_CSV_TRANS),
+                (d.get("care") or "").translate(_CSV_TRANS),
+                d.get("image", ""),
+            ])
+
+    headers = {
+        "Content-Disposition": "attachment; filename=products.csv",
+        "Vary": "Accept-Encoding",
+    }
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(_gzip_stream(gen()), media_type="text/csv", headers=headers)
+    return StreamingResponse(gen(), media_type="text/csv", headers=headers)
+
+# Webhooks
+async def send_webhook(url: str, payload: dict):
     try:
-        if webhook_url:
-            requests.post(webhook_url, json={"type": "order", "id": oid, **order.model_dump()})
+        await app.state.http.post(url, json=payload)
     except Exception:
         pass
+
+# Orders
+@app.post("/api/orders")
+async def create_order(order: OrderSchema, background_tasks: BackgroundTasks):
+    # Dumped once and shared by the insert and the webhook
+    payload = order.model_dump(mode="json")
+    oid = await create_document_dict(COLL_ORDERS, payload)
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        background_tasks.add_task(send_webhook, webhook_url, {"type": "order", "id": oid, **payload})
     return {"id": oid}
 
 # Contact
 @app.post("/api/contact")
-def create_contact(msg: ContactSchema):
-    cid = create_document(COLL_CONTACT, msg)
+async def create_contact(msg: ContactSchema, background_tasks: BackgroundTasks):
+    payload = msg.model_dump(mode="json")
+    cid = await create_document_dict(COLL_CONTACT, payload)
     webhook_url = os.getenv("WEBHOOK_URL")
-    try:
-        if webhook_url:
-            requests.post(webhook_url, json={"type": "contact", "id": cid, **msg.model_dump()})
-    except Exception:
-        pass
+    if webhook_url:
+        background_tasks.add_task(send_webhook, webhook_url, {"type": "contact", "id": cid, **payload})
     return {"id": cid}
 
 # Gallery and posts (read-only collections for site content)
-@app.get("/api/gallery", response_model=List[dict])
-def list_gallery():
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    docs = get_documents(COLL_GALLERY)
-    # Ensure id is string and alt exists
+@app.get("/api/gallery", response_class=MongoJSONResponse)
+async def list_gallery(db: AsyncIOMotorDatabase = Depends(require_db)):
+    docs = await get_documents(COLL_GALLERY, projection=GALLERY_FIELDS)
+    # Expose _id as id (stringified on render) and ensure alt exists
     for d in docs:
-        d["id"] = str(d.pop("_id")) if d.get("_id") else None
+        d["id"] = d.pop("_id", None)
         d.setdefault("alt", d.get("title", "Fotografija"))
-    return docs
+    return MongoJSONResponse(docs)
 
-@app.get("/api/posts", response_model=List[dict])
-def list_posts():
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    docs = db[COLL_POSTS].find({"published": True}).sort("_id", -1)
+@app.get("/api/posts", response_class=MongoJSONResponse)
+async def list_posts(db: AsyncIOMotorDatabase = Depends(require_db)):
+    docs = await db[COLL_POSTS].find({"published": True}, POST_LIST_FIELDS).sort("_id", -1).to_list(length=None)
     out = []
     for d in docs:
-        d["id"] = str(d.pop("_id"))
+        d["id"] = d.pop("_id")
         out.append(d)
-    return out
+    return MongoJSONResponse(out)
+
+@app.get("/api/posts/{slug}", response_class=MongoJSONResponse)
+async def get_post(slug: str, db: AsyncIOMotorDatabase = Depends(require_db)):
+    doc = await db[COLL_POSTS].find_one({"slug": slug, "published": True})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Not found")
+    doc["id"] = doc.pop("_id")
+    return MongoJSONResponse(doc)
 
 # Schemas endpoint for admin tooling
-@app.get("/schema")
-def get_schema_info():
-    return {
-        "collections": [
-            {
-                "name": "product",
-                "fields": list(ProductSchema.model_fields.keys()),
-            },
-            {
-                "name": "order",
-                "fields": list(OrderSchema.model_fields.keys()),
-            },
-            {
-                "name": "contact",
-                "fields": list(ContactSchema.model_fields.keys()),
-            },
-            {
-                "name": "gallery",
-                "fields": list(GallerySchema.model_fields.keys()),
-            },
-            {
-                "name": "post",
-                "fields": list(PostSchema.model_fields.keys()),
-            },
-        ]
-    }
+# Model fields are fixed at import time, so the payload is built once
+_SCHEMA_INFO = {
+    "collections": [
+        {
+            "name": "product",
+            "fields": list(ProductSchema.model_fields),
+        },
+        {
+            "name": "order",
+            "fields": list(OrderSchema.model_fields),
+        },
+        {
+            "name": "contact",
+            "fields": list(ContactSchema.model_fields),
+        },
+        {
+            "name": "gallery",
+            "fields": list(GallerySchema.model_fields),
+        },
+        {
+            "name": "post",
+            "fields": list(PostSchema.model_fields),
+        },
+    ]
+}
+
+@app.get("/schema", response_class=ORJSONResponse)
+async def get_schema_info():
+    return ORJSONResponse(_SCHEMA_INFO)
 
 if __name__ == "__main__":
     import uvicorn